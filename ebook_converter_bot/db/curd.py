@@ -1,35 +1,42 @@
-from sqlalchemy.sql.functions import sum
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+from sqlalchemy import case, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from ebook_converter_bot.db.models.analytics import Analytics
 from ebook_converter_bot.db.models.chat import Chat
 from ebook_converter_bot.db.models.preference import Preference
-from ebook_converter_bot.db.session import session
+from ebook_converter_bot.db.session import SessionLocal, session
+
+LANGUAGE_CACHE_TTL = 300  # 5 minutes
+LANGUAGE_CACHE_SIZE = 1024
+# user_id -> (language, expiry time), least recently queried first
+_lang_cache: OrderedDict[int, tuple[str, float]] = OrderedDict()
 
 
 def generate_analytics_columns(formats: list[str]) -> None:
-    if not session.query(Analytics).first():
-        formats_columns = [Analytics(format=i) for i in formats]
-        session.add_all(formats_columns)
+    if not session.query(Analytics.id).first():
+        session.execute(insert(Analytics), [{"format": i} for i in formats])
         session.commit()
 
 
 def update_format_analytics(file_format: str, output: bool = False) -> None:
-    file_format_analytics: Analytics | None = (
-        session.query(Analytics).filter(Analytics.format == file_format).first()
+    column = Analytics.output_times if output else Analytics.input_times
+    session.query(Analytics).filter(Analytics.format == file_format).update(
+        {column: column + 1}, synchronize_session=False
     )
-    if not file_format_analytics:
-        return
-    if output:
-        file_format_analytics.output_times += 1
-    else:
-        file_format_analytics.input_times += 1
     session.commit()
 
 
 def add_chat_to_db(user_id: int, user_name: str, chat_type: int) -> None:
-    if not session.query(Chat).filter(Chat.user_id == user_id).first():
-        session.add(Chat(user_id=user_id, user_name=user_name, type=chat_type))
-        session.commit()
+    session.execute(
+        sqlite_insert(Chat)
+        .values(user_id=user_id, user_name=user_name, type=chat_type)
+        .on_conflict_do_nothing(index_elements=[Chat.user_id])
+    )
+    session.commit()
 
 
 def remove_chat(user_id: int) -> bool:
@@ -42,56 +49,97 @@ def remove_chat(user_id: int) -> bool:
 
 
 def increment_usage(user_id: int) -> None:
-    chat = session.query(Chat).filter(Chat.user_id == user_id).first()
-    if not chat:
-        return
-    chat.usage_times += 1
+    session.query(Chat).filter(Chat.user_id == user_id).update(
+        {Chat.usage_times: Chat.usage_times + 1}, synchronize_session=False
+    )
     session.commit()
 
 
 def update_language(user_id: int, language: str) -> None:
-    chat: Preference | None = (
-        session.query(Preference).filter(Preference.user_id == user_id).first()
+    stmt = sqlite_insert(Preference).values(user_id=user_id, language=language)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[Preference.user_id],
+            set_={Preference.language: stmt.excluded.language},
+        )
     )
-    if not chat:
-        chat = Preference(user_id=user_id, language=language)
-        session.add(chat)
-    else:
-        chat.language = language
     session.commit()
-
-
-def get_lang(user_id: int) -> str:
-    language: str = (
-        session.query(Preference.language)
-        .filter(Preference.user_id == user_id)
-        .scalar()
-    )
-    return language or "en"
+    _lang_cache.pop(user_id, None)
+
+
+def _get_cached_lang(user_id: int) -> str | None:
+    cached = _lang_cache.get(user_id)
+    if cached is None:
+        return None
+    if cached[1] > monotonic():
+        return cached[0]
+    _lang_cache.pop(user_id, None)
+    return None
+
+
+def _query_lang(user_id: int) -> str:
+    # The shared session must not be used from another thread
+    with SessionLocal() as thread_session:
+        language: str = (
+            thread_session.execute(
+                select(Preference.language).where(Preference.user_id == user_id)
+            ).scalar()
+            or "en"
+        )
+    # Re-insert so the entry moves to the end, then drop the oldest ones
+    _lang_cache.pop(user_id, None)
+    _lang_cache[user_id] = (language, monotonic() + LANGUAGE_CACHE_TTL)
+    while len(_lang_cache) > LANGUAGE_CACHE_SIZE:
+        _lang_cache.popitem(last=False)
+    return language
+
+
+async def aget_lang(user_id: int) -> str:
+    """Get the chat language, from the cache or, on a miss, from the database in a
+    worker thread so the event loop isn't blocked.
+    """
+    if (cached := _get_cached_lang(user_id)) is not None:
+        return cached
+    return await asyncio.to_thread(_query_lang, user_id)
 
 
 def get_chats_count() -> tuple[int, int]:
-    all_chats = session.query(Chat).count()
-    active_chats = session.query(Chat).filter(Chat.usage_times > 0).count()
+    all_chats, active_chats = session.execute(
+        select(func.count(Chat.id), func.count(case((Chat.usage_times > 0, 1))))
+    ).one()
     return all_chats, active_chats
 
 
 def get_usage_count() -> tuple[int, int]:
-    usage_times: int = session.query(sum(Chat.usage_times)).scalar() or 0
-    output_times: int = session.query(sum(Analytics.output_times)).scalar()
-    return usage_times, output_times
+    usage_times, output_times = session.execute(
+        select(
+            select(func.sum(Chat.usage_times)).scalar_subquery(),
+            select(func.sum(Analytics.output_times)).scalar_subquery(),
+        )
+    ).one()
+    return usage_times or 0, output_times
 
 
 def get_top_formats() -> tuple[dict[str, int], dict[str, int]]:
-    out_formats: list[Analytics] = (
-        session.query(Analytics).order_by(Analytics.output_times.desc()).limit(5).all()
+    out_formats = (
+        session.execute(
+            select(Analytics.format, Analytics.output_times)
+            .order_by(Analytics.output_times.desc())
+            .limit(5)
+        )
+        .tuples()
+        .all()
     )
-    in_formats: list[Analytics] = (
-        session.query(Analytics).order_by(Analytics.input_times.desc()).limit(5).all()
+    in_formats = (
+        session.execute(
+            select(Analytics.format, Analytics.input_times)
+            .order_by(Analytics.input_times.desc())
+            .limit(5)
+        )
+        .tuples()
+        .all()
     )
-    return {i.format: i.output_times for i in out_formats}, {
-        i.format: i.input_times for i in in_formats
-    }
+    return dict(out_formats), dict(in_formats)
 
 
 def get_all_chats() -> list[Chat]:
@@ -15,5 +15,7 @@ engine = create_engine(db_connection_string, connect_args={"check_same_thread":
 
 Base.metadata.create_all(bind=engine)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
 session = SessionLocal()
@@ -13,7 +13,7 @@ from telethon.tl.types import Message
 
 from ebook_converter_bot import TG_BOT_ADMINS
 from ebook_converter_bot.bot import BOT
-from ebook_converter_bot.db.curd import get_all_chats, get_lang, remove_chat
+from ebook_converter_bot.db.curd import aget_lang, get_all_chats, remove_chat
 from ebook_converter_bot.db.models.chat import Chat
 from ebook_converter_bot.utils.i18n import translate as _
 from ebook_converter_bot.utils.telegram import tg_exceptions_handler
@@ -31,7 +31,7 @@ logger = logging.getLogger(__name__)
 @tg_exceptions_handler
 async def broadcast_handler(event: events.NewMessage.Event) -> None:
     """Broadcasts message to bot users."""
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     message_to_send: Message = await event.get_reply_message()
     failed_to_send = 0
     sent_successfully = 0
@@ -1,23 +1,73 @@
 """Converter."""
 
+import re
+from collections import OrderedDict
 from pathlib import Path
-from random import sample
-from string import digits
+from secrets import randbits
+from time import monotonic
 
 from telethon import Button, events
 from telethon.tl.custom import Message, MessageButton
 
 from ebook_converter_bot.bot import BOT
-from ebook_converter_bot.db.curd import get_lang
+from ebook_converter_bot.db.curd import aget_lang
 from ebook_converter_bot.utils.analytics import analysis
-from ebook_converter_bot.utils.convert import Converter
+from ebook_converter_bot.utils.convert import Converter, remove_files
 from ebook_converter_bot.utils.i18n import translate as _
 from ebook_converter_bot.utils.telegram import tg_exceptions_handler
 
 MAX_ALLOWED_FILE_SIZE = 26214400  # 25 MB
+QUEUE_TTL_SECONDS = 3600  # 1 hour
+CONVERT_CALLBACK_PATTERN = re.compile(rb"(?P<output_type>\w+)\|(?P<request_id>\d+)")
+
+HIGHLIGHTED_FORMATS = {"azw3", "docx", "epub", "kfx", "mobi", "pdf"}
 
 converter = Converter()
-queue = {}
+_format_buttons = [
+    (
+        f"🔸 {output_type}" if output_type in HIGHLIGHTED_FORMATS else output_type,
+        f"{output_type}|".encode(),
+    )
+    for output_type in sorted(converter.supported_output_types)
+]
+# (label, callback data prefix) of each format button, in 5 rows
+FORMAT_BUTTONS_TEMPLATE = tuple(tuple(_format_buttons[i::5]) for i in range(5))
+# request id -> (downloaded file, queued at), oldest first
+queue: OrderedDict[str, tuple[Path, float]] = OrderedDict()
+# input files of the requests being converted right now
+converting: set[Path] = set()
+
+
+def unused_files(files: list[Path]) -> list[Path]:
+    """Filter out files that a queued or in-progress request still uses.
+
+    Uploads with the same name share a path, so a file can outlive its request.
+    """
+    used_files = {input_file for input_file, _ in queue.values()} | converting
+    return [file for file in files if file not in used_files]
+
+
+async def evict_expired_requests() -> None:
+    """Remove requests that were not converted in time along with their files."""
+    now = monotonic()
+    expired_files: list[Path] = []
+    while queue:
+        input_file, queued_at = next(iter(queue.values()))
+        if queued_at + QUEUE_TTL_SECONDS > now:
+            break
+        queue.popitem(last=False)
+        expired_files.append(input_file)
+    if expired_files:
+        await remove_files(*unused_files(expired_files))
+
+
+def options_labels(lang: str) -> dict[str, str]:
+    """Translated labels of the conversion option buttons."""
+    return {
+        "rtl": _("Force RTL", lang),
+        "fix_epub": _("Fix EPUB before converting", lang),
+        "flat_toc": _("Flatten EPUB TOC", lang),
+    }
 
 
 @BOT.on(events.NewMessage(func=lambda x: x.message.file and x.is_private))
@@ -25,7 +75,7 @@ queue = {}
 @tg_exceptions_handler
 async def file_converter(event: events.NewMessage.Event) -> None:
     """Convert ebook to another format."""
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     if event.pattern_match:
         message = await event.get_reply_message()
         file = message.file
@@ -34,57 +84,39 @@ async def file_converter(event: events.NewMessage.Event) -> None:
         file = event.message.file
     if not file:
         return
-    if not converter.is_supported_input_type(file.name):
+    input_type = converter.get_file_type(file.name)
+    if input_type not in converter.supported_input_types:
         # Unsupported file
         await event.reply(_("The file you sent is not a supported type!", lang))
         return
     if file.size > MAX_ALLOWED_FILE_SIZE:
         await event.reply(_("Files larger than 25 MB are not supported!", lang))
         return
+    await evict_expired_requests()
     reply = await event.reply(_("Downloading the file...", lang))
-    downloaded = await message.download_media(f"/tmp/{file.name}")  # noqa: S108
-    if " " in downloaded:
-        Path(downloaded).rename(downloaded.replace(" ", "_"))
-        downloaded = downloaded.replace(" ", "_")
-    random_id = "".join(sample(digits, 8))
-    queue.update({random_id: downloaded})
+    downloaded = Path(await message.download_media(f"/tmp/{file.name}"))  # noqa: S108
+    if " " in downloaded.name:
+        downloaded = downloaded.rename(
+            downloaded.with_name(downloaded.name.replace(" ", "_"))
+        )
+    random_id = str(randbits(30))
+    # A reused id must move to the end to keep the queue oldest first
+    previous = queue.pop(random_id, None)
+    queue[random_id] = (downloaded, monotonic())
+    if previous:
+        await remove_files(*unused_files([previous[0]]))
+    request_id = random_id.encode()
     buttons = [
-        Button.inline("🔸 azw3", data=f"azw3|{random_id}"),
-        Button.inline("🔸 docx", data=f"docx|{random_id}"),
-        Button.inline("🔸 epub", data=f"epub|{random_id}"),
-        Button.inline("fb2", data=f"fb2|{random_id}"),
-        Button.inline("htmlz", data=f"htmlz|{random_id}"),
-        Button.inline("🔸 kfx", data=f"kfx|{random_id}"),
-        Button.inline("lit", data=f"lit|{random_id}"),
-        Button.inline("lrf", data=f"lrf|{random_id}"),
-        Button.inline("🔸 mobi", data=f"mobi|{random_id}"),
-        Button.inline("oeb", data=f"oeb|{random_id}"),
-        Button.inline("pdb", data=f"pdb|{random_id}"),
-        Button.inline("🔸 pdf", data=f"pdf|{random_id}"),
-        Button.inline("pmlz", data=f"pmlz|{random_id}"),
-        Button.inline("rb", data=f"rb|{random_id}"),
-        Button.inline("rtf", data=f"rtf|{random_id}"),
-        Button.inline("snb", data=f"snb|{random_id}"),
-        Button.inline("tcr", data=f"tcr|{random_id}"),
-        Button.inline("txt", data=f"txt|{random_id}"),
-        Button.inline("txtz", data=f"txtz|{random_id}"),
-        Button.inline("zip", data=f"zip|{random_id}"),
+        [Button.inline(label, data=prefix + request_id) for label, prefix in row]
+        for row in FORMAT_BUTTONS_TEMPLATE
     ]
-    buttons = [buttons[i::5] for i in range(5)]
-    buttons.append([Button.inline(_("Force RTL", lang) + " ❓", data="rtl_disabled")])
-    if file.name.lower().endswith(".epub"):
+    labels = options_labels(lang)
+    buttons.append([Button.inline(labels["rtl"] + " ❓", data=b"rtl_disabled")])
+    if input_type == "epub":
         buttons.extend(
             [
-                [
-                    Button.inline(
-                        _("Fix EPUB before converting", lang) + " ❓", data="epub_keep"
-                    )
-                ],
-                [
-                    Button.inline(
-                        _("Flatten EPUB TOC", lang) + " ❓", data="epub_keep_toc"
-                    )
-                ],
+                [Button.inline(labels["fix_epub"] + " ❓", data=b"epub_keep")],
+                [Button.inline(labels["flat_toc"] + " ❓", data=b"epub_keep_toc")],
             ]
         )
     await reply.edit(
@@ -97,19 +129,16 @@ async def file_converter(event: events.NewMessage.Event) -> None:
 async def rtl_enable_callback(event: events.CallbackQuery.Event) -> None:
     """RTL callback handler."""
     message: Message = await event.get_message()
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     epub_button_row = None
     if message.buttons[-1][0].data.startswith(b"epub"):
         epub_button_row = message.buttons.pop(-1)
     rtl_button_row: list[MessageButton] = message.buttons[5]
+    label = options_labels(lang)["rtl"]
     if event.data == b"rtl_disabled":
-        rtl_button_row[0] = Button.inline(
-            _("Force RTL", lang) + " ✅", data="rtl_enabled"
-        )
+        rtl_button_row[0] = Button.inline(label + " ✅", data=b"rtl_enabled")
     elif event.data == b"rtl_enabled":
-        rtl_button_row[0] = Button.inline(
-            _("Force RTL", lang) + " ❌", data="rtl_disabled"
-        )
+        rtl_button_row[0] = Button.inline(label + " ❌", data=b"rtl_disabled")
     message.buttons[5] = rtl_button_row
     if epub_button_row:
         message.buttons.append(epub_button_row)
@@ -121,16 +150,13 @@ async def rtl_enable_callback(event: events.CallbackQuery.Event) -> None:
 async def epub_fix_enable_callback(event: events.CallbackQuery.Event) -> None:
     """Epub Fix callback handler."""
     message: Message = await event.get_message()
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     epub_button_row: list[MessageButton] = message.buttons[-2]
+    label = options_labels(lang)["fix_epub"]
     if event.data == b"epub_keep":
-        epub_button_row[0] = Button.inline(
-            _("Fix EPUB before converting", lang) + " ✅", data="epub_fix"
-        )
+        epub_button_row[0] = Button.inline(label + " ✅", data=b"epub_fix")
     elif event.data == b"epub_fix":
-        epub_button_row[0] = Button.inline(
-            _("Fix EPUB before converting", lang) + " ❌", data="epub_keep"
-        )
+        epub_button_row[0] = Button.inline(label + " ❌", data=b"epub_keep")
     message.buttons[-2] = epub_button_row
     await message.edit(message.text, buttons=message.buttons)
 
@@ -140,21 +166,18 @@ async def epub_fix_enable_callback(event: events.CallbackQuery.Event) -> None:
 async def epub_toc_edit_enable_callback(event: events.CallbackQuery.Event) -> None:
     """Epub TOC edit callback handler."""
     message: Message = await event.get_message()
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     epub_button_row: list[MessageButton] = message.buttons[-1]
+    label = options_labels(lang)["flat_toc"]
     if event.data == b"epub_keep_toc":
-        epub_button_row[0] = Button.inline(
-            _("Flatten EPUB TOC", lang) + " ✅", data="epub_flat_toc"
-        )
+        epub_button_row[0] = Button.inline(label + " ✅", data=b"epub_flat_toc")
     elif event.data == b"epub_flat_toc":
-        epub_button_row[0] = Button.inline(
-            _("Flatten EPUB TOC", lang) + " ❌", data="epub_flat_toc"
-        )
+        epub_button_row[0] = Button.inline(label + " ❌", data=b"epub_keep_toc")
     message.buttons[-1] = epub_button_row
     await message.edit(message.text, buttons=message.buttons)
 
 
-@BOT.on(events.CallbackQuery(pattern=r"\w+\|\d+"))
+@BOT.on(events.CallbackQuery(pattern=CONVERT_CALLBACK_PATTERN))
 @tg_exceptions_handler
 @analysis
 async def converter_callback(
@@ -170,47 +193,50 @@ async def converter_callback(
         flat_toc = message.buttons[-1][0].data == b"epub_flat_toc"
     else:
         convert_to_rtl = message.buttons[-1][0].data == b"rtl_enabled"
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     converted = False
-    output_type: str
-    random_id: str
-    output_type, random_id = event.data.decode().split("|")
-    if not queue.get(random_id):
+    output_type: str = event.data_match["output_type"].decode()
+    random_id: str = event.data_match["request_id"].decode()
+    request = queue.get(random_id)
+    if not request or request[1] + QUEUE_TTL_SECONDS <= monotonic():
         return None
-    input_file = Path(queue[random_id])
+    input_file = request[0]
     if not input_file.exists():
         return None
     del queue[random_id]
-    reply = await event.edit(
-        _("Converting the file to {}...", lang).format(output_type)
-    )
-    output_file, converted_to_rtl, conversion_error = await converter.convert_ebook(
-        input_file,
-        output_type,
-        force_rtl=convert_to_rtl,
-        fix_epub=fix_epub,
-        flat_toc=flat_toc,
-    )
-    if output_file.exists():
-        message_text = ""
-        if convert_to_rtl and converted_to_rtl:
-            message_text += _("Converted to RTL successfully!\n", lang)
-        message_text += _("Done! Uploading the converted file...", lang)
-        await reply.edit(message_text)
-        await event.client.send_file(
-            event.chat, output_file, reply_to=reply, force_document=True
+    converting.add(input_file)
+    try:
+        reply = await event.edit(
+            _("Converting the file to {}...", lang).format(output_type)
         )
-        converted = True
-    else:
-        input_file_name = input_file.name
-        error_message = _("Failed to convert the file (`{}`) to {} :(", lang).format(
-            input_file_name, output_type
+        output_file, converted_to_rtl, conversion_error = await converter.convert_ebook(
+            input_file,
+            output_type,
+            force_rtl=convert_to_rtl,
+            fix_epub=fix_epub,
+            flat_toc=flat_toc,
         )
-        if conversion_error:
-            error_message += f"\n\n`{conversion_error}`"
-        await reply.edit(error_message)
-    input_file.unlink(missing_ok=True)
-    output_file.unlink(missing_ok=True)
+        if output_file.exists():
+            message_text = ""
+            if convert_to_rtl and converted_to_rtl:
+                message_text += _("Converted to RTL successfully!\n", lang)
+            message_text += _("Done! Uploading the converted file...", lang)
+            await reply.edit(message_text)
+            await event.client.send_file(
+                event.chat, output_file, reply_to=reply, force_document=True
+            )
+            converted = True
+        else:
+            input_file_name = input_file.name
+            error_message = _(
+                "Failed to convert the file (`{}`) to {} :(", lang
+            ).format(input_file_name, output_type)
+            if conversion_error:
+                error_message += f"\n\n`{conversion_error}`"
+            await reply.edit(error_message)
+        await remove_files(input_file, output_file)
+    finally:
+        converting.discard(input_file)
     if converted:
         return input_file.suffix, output_type
     return None
@@ -3,7 +3,7 @@
 from telethon import events
 
 from ebook_converter_bot.bot import BOT, BOT_INFO
-from ebook_converter_bot.db.curd import add_chat_to_db, get_lang
+from ebook_converter_bot.db.curd import add_chat_to_db, aget_lang
 from ebook_converter_bot.utils.i18n import translate as _
 from ebook_converter_bot.utils.telegram import (
     get_chat_name,
@@ -17,6 +17,7 @@ from ebook_converter_bot.utils.telegram import (
 async def start(event: events.NewMessage.Event) -> None:
     """Send a message when the command /start is sent."""
     add_chat_to_db(event.chat_id, get_chat_name(event), get_chat_type(event))
+    lang = await aget_lang(event.chat_id)
     await event.reply(
         _(
             "Hello {}!\n\n \
@@ -25,7 +26,7 @@ async def start(event: events.NewMessage.Event) -> None:
         convert features.\n\n \
         The bot is open source, you can find the source code of it [here](https://github.com/yshalsager/ebook-converter-bot).\n \
         Developed by: [yshalsager](https://t.me/yshalsager/).",
-            get_lang(event.chat_id),
+            lang,
         ).format(
             event.chat.first_name
             if hasattr(event.chat, "first_name")
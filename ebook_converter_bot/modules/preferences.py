@@ -1,18 +1,22 @@
+import re
+
 from telethon import Button, events
 
 from ebook_converter_bot import LOCALES
 from ebook_converter_bot.bot import BOT
-from ebook_converter_bot.db.curd import get_lang, update_language
+from ebook_converter_bot.db.curd import aget_lang, update_language
 from ebook_converter_bot.utils.i18n import translate as _
 from ebook_converter_bot.utils.telegram import tg_exceptions_handler
 
+SET_LANGUAGE_CALLBACK_PATTERN = re.compile(rb"setlanguage_(?P<code>\w+)")
+
 
 @BOT.on(events.NewMessage(pattern="/settings|/preferences"))
 @BOT.on(events.CallbackQuery(pattern="update_preferences"))
 @tg_exceptions_handler
 async def preferences_handler(event: events.NewMessage.Event) -> None:
     """Set chat preferences."""
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     buttons = [Button.inline(_("Language", lang), data="update_language")]
     message = _("**Available bot preferences:**", lang)
     (
@@ -26,7 +30,7 @@ async def preferences_handler(event: events.NewMessage.Event) -> None:
 @tg_exceptions_handler
 async def update_language_callback(event: events.CallbackQuery.Event) -> None:
     """Update language handler."""
-    lang = get_lang(event.chat_id)
+    lang = await aget_lang(event.chat_id)
     buttons = [
         Button.inline(
             f"{i['name']} ({i['nativeName']})", data=f"setlanguage_{i['code']}"
@@ -38,20 +42,19 @@ async def update_language_callback(event: events.CallbackQuery.Event) -> None:
     )
 
 
-@BOT.on(events.CallbackQuery(pattern=r"setlanguage_\w+"))
+@BOT.on(events.CallbackQuery(pattern=SET_LANGUAGE_CALLBACK_PATTERN))
 @tg_exceptions_handler
 async def set_language_callback(event: events.CallbackQuery.Event) -> None:
     """Set language handler."""
-    language_code = event.data.decode().split("_")[-1]
+    language_code = event.data_match["code"].decode()
     update_language(event.chat_id, language_code)
     language = next(iter(filter(lambda x: x["code"] == language_code, LOCALES)))
     language_name = language["name"]
     language_native_name = language["nativeName"]
+    lang = await aget_lang(event.chat_id)
     await event.edit(
-        _("**Language has been set to**: {} ({})", get_lang(event.chat_id)).format(
+        _("**Language has been set to**: {} ({})", lang).format(
             language_name, language_native_name
         ),
-        buttons=[
-            Button.inline(_("Back", get_lang(event.chat_id)), data="update_language")
-        ],
+        buttons=[Button.inline(_("Back", lang), data="update_language")],
     )
@@ -1,11 +1,13 @@
 import asyncio
 import logging
 import re
-from asyncio.subprocess import PIPE, STDOUT, Process
+import shlex
+from asyncio.subprocess import DEVNULL, PIPE, STDOUT, Process
+from collections import deque
+from collections.abc import Iterable
 from os import getpgid, killpg, setsid
 from pathlib import Path
 from signal import SIGKILL
-from string import Template
 from typing import ClassVar
 
 from ebook_converter_bot.utils.epub import (
@@ -16,133 +18,181 @@ from ebook_converter_bot.utils.epub import (
 
 logger = logging.getLogger(__name__)
 
+CONVERSION_ERROR_PATTERN = re.compile(
+    r"(Conversion Failure Reason\s+\*{5,}\s+[E\d]+:.*)|(Conversion error: .*)"
+)
+LOG_SKIP_WORDS = (b":fixme:", b"DEBUG -", b"INFO -")
+# Only the last lines of the output are kept, calibre reports errors at the end
+LOG_TAIL_LINES = 2000
+OUTPUT_CHUNK_SIZE = 2**16
+# Longer lines are cut, the rest of the line is dropped
+OUTPUT_LINE_LIMIT = 2**20
+
+
+def _unlink_files(files: Iterable[Path]) -> None:
+    for file in files:
+        file.unlink(missing_ok=True)
+
+
+async def remove_files(*files: Path) -> None:
+    """Delete files in a worker thread so slow disks don't block the event loop."""
+    await asyncio.to_thread(_unlink_files, files)
+
 
 class Converter:
-    supported_input_types: ClassVar[list[str]] = [
-        "azw",
-        "azw3",
-        "azw4",
-        "azw8",
-        "cb7",
-        "cbc",
-        "cbr",
-        "cbz",
-        "chm",
-        "djvu",
-        "docx",
-        "doc",
-        "epub",
-        "fb2",
-        "fbz",
-        "html",
-        "htmlz",
-        "kfx",
-        "kfx-zip",
-        "kpf",
-        "lit",
-        "lrf",
-        "mobi",
-        "odt",
-        "opf",
-        "pdb",
-        "pml",
-        "prc",
-        "rb",
-        "rtf",
-        "snb",
-        "tcr",
-        "txt",
-        "txtz",
-    ]
-    supported_output_types: ClassVar[list[str]] = [
-        "azw3",
-        "docx",
-        "epub",
-        "fb2",
-        "htmlz",
-        "kfx",
-        "lit",
-        "lrf",
-        "mobi",
-        "oeb",
-        "pdb",
-        "pdf",
-        "pmlz",
-        "rb",
-        "rtf",
-        "snb",
-        "tcr",
-        "txt",
-        "txtz",
-        "zip",
-    ]
-    kfx_output_allowed_types: ClassVar[list[str]] = [
-        "epub",
-        "opf",
-        "mobi",
-        "doc",
-        "docx",
-        "kpf",
-        "kfx-zip",
-    ]
-    kfx_input_allowed_types: ClassVar[list[str]] = ["azw8", "kfx", "kfx-zip"]
+    supported_input_types: ClassVar[frozenset[str]] = frozenset(
+        {
+            "azw",
+            "azw3",
+            "azw4",
+            "azw8",
+            "cb7",
+            "cbc",
+            "cbr",
+            "cbz",
+            "chm",
+            "djvu",
+            "docx",
+            "doc",
+            "epub",
+            "fb2",
+            "fbz",
+            "html",
+            "htmlz",
+            "kfx",
+            "kfx-zip",
+            "kpf",
+            "lit",
+            "lrf",
+            "mobi",
+            "odt",
+            "opf",
+            "pdb",
+            "pml",
+            "prc",
+            "rb",
+            "rtf",
+            "snb",
+            "tcr",
+            "txt",
+            "txtz",
+        }
+    )
+    supported_output_types: ClassVar[frozenset[str]] = frozenset(
+        {
+            "azw3",
+            "docx",
+            "epub",
+            "fb2",
+            "htmlz",
+            "kfx",
+            "lit",
+            "lrf",
+            "mobi",
+            "oeb",
+            "pdb",
+            "pdf",
+            "pmlz",
+            "rb",
+            "rtf",
+            "snb",
+            "tcr",
+            "txt",
+            "txtz",
+            "zip",
+        }
+    )
+    kfx_output_allowed_types: ClassVar[frozenset[str]] = frozenset(
+        {
+            "epub",
+            "opf",
+            "mobi",
+            "doc",
+            "docx",
+            "kpf",
+            "kfx-zip",
+        }
+    )
+    kfx_input_allowed_types: ClassVar[frozenset[str]] = frozenset(
+        {"azw8", "kfx", "kfx-zip"}
+    )
 
     def __init__(self) -> None:
-        self._convert_command = Template('ebook-convert "$input_file" "$output_file"')
+        self._convert_command = ("ebook-convert",)
         # TODO: Add the ability to use converter options
         # https://manual.calibre-ebook.com/generated/en/ebook-convert.html
-        self._kfx_input_convert_command = Template(
-            'calibre-debug -r "KFX Input" -- "$input_file"'
-        )  # KFX to EPUB
-        self._kfx_output_convert_command = Template(
-            'calibre-debug -r "KFX Output" -- "$input_file"'
-        )
+        # KFX to EPUB
+        self._kfx_input_convert_command = ("calibre-debug", "-r", "KFX Input", "--")
+        self._kfx_output_convert_command = ("calibre-debug", "-r", "KFX Output", "--")
 
     @classmethod
     def get_supported_types(cls) -> list[str]:
-        return sorted(set(cls.supported_input_types + cls.supported_output_types))
+        return sorted(cls.supported_input_types | cls.supported_output_types)
 
-    def is_supported_input_type(self, input_file: str) -> bool:
-        return input_file.lower().split(".")[-1] in self.supported_input_types
+    @staticmethod
+    def get_file_type(file_name: str) -> str:
+        return file_name.rpartition(".")[2].lower()
 
     @staticmethod
-    async def _run_command(command: str) -> tuple[int | None, str]:
+    async def _read_output(process: Process) -> str:
+        """Read the process output in chunks as it is produced, dropping
+        noisy log lines and keeping only a bounded tail, then wait for it to exit.
+        """
+        assert process.stdout is not None
+        lines: deque[bytes] = deque(maxlen=LOG_TAIL_LINES)
+        partial_line = b""
+        skipping_line = False
+        while chunk := await process.stdout.read(OUTPUT_CHUNK_SIZE):
+            if skipping_line:
+                line_end = chunk.find(b"\n")
+                if line_end == -1:
+                    continue
+                chunk = chunk[line_end:]
+                skipping_line = False
+            *complete_lines, partial_line = (partial_line + chunk).split(b"\n")
+            lines.extend(
+                line
+                for line in complete_lines
+                if not any(word in line for word in LOG_SKIP_WORDS)
+            )
+            if len(partial_line) > OUTPUT_LINE_LIMIT:
+                partial_line = partial_line[:OUTPUT_LINE_LIMIT]
+                skipping_line = True
+        if partial_line and not any(word in partial_line for word in LOG_SKIP_WORDS):
+            lines.append(partial_line)
+        await process.wait()
+        return b"\n".join(lines).decode(errors="replace").rstrip("\n")
+
+    async def _run_command(self, *command: str | Path) -> tuple[int | None, str]:
         conversion_error = ""
-        process: Process = await asyncio.create_subprocess_shell(  # noqa: S604
-            command,
-            stdin=PIPE,
+        process: Process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=DEVNULL,
             stdout=PIPE,
             stderr=STDOUT,
-            shell=True,
             preexec_fn=setsid,
         )
         try:
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(), timeout=600
+            output = await asyncio.wait_for(
+                self._read_output(process), timeout=600
             )  # wait for 10 minutes
-            output = "\n".join(
-                [
-                    i
-                    for i in stdout.decode().splitlines()
-                    if all(word not in i for word in [":fixme:", "DEBUG -", "INFO -"])
-                ]
-            )
             logger.info(output)
-            if errors_list := re.findall(
-                r"(Conversion Failure Reason\s+\*{5,}\s+[E\d]+:.*)|(Conversion error: .*)",
-                output,
-            ):
+            if errors_list := CONVERSION_ERROR_PATTERN.findall(output):
                 conversion_error = "\n".join(
                     [error[0].strip() or error[1].strip() for error in errors_list]
                 ).replace("*", "")
         except asyncio.exceptions.TimeoutError:
-            logger.info(f"Timeout while running command: {command}")
-        try:
-            # If it timed out terminate the process and its child processes.
-            killpg(getpgid(process.pid), SIGKILL)
-            process.kill()
-        except OSError:
-            pass  # Ignore 'no such process' error
+            logger.info(
+                f"Timeout while running command: {shlex.join(map(str, command))}"
+            )
+        finally:
+            if process.returncode is None:
+                try:
+                    # It timed out or failed, terminate the process and its children.
+                    killpg(getpgid(process.pid), SIGKILL)
+                    process.kill()
+                except ProcessLookupError:
+                    pass  # It exited in the meantime
         return process.returncode, conversion_error
 
     async def _convert_to_kfx(self, input_file: Path) -> tuple[int | None, str]:
@@ -150,9 +200,7 @@ class Converter:
         :param input_file: Pathname of the .epub, .opf, .mobi, .doc, .docx, .kpf, or .kfx-zip file to be converted
         :return:
         """
-        return await self._run_command(
-            self._kfx_output_convert_command.safe_substitute(input_file=input_file)
-        )
+        return await self._run_command(*self._kfx_output_convert_command, input_file)
 
     async def _convert_from_kfx_to_epub(
         self, input_file: Path
@@ -161,9 +209,7 @@ class Converter:
         :param input_file: Pathname of the .azw8, .kfx, .kfx-zip, or .kpf file to be processed
         :return:
         """
-        return await self._run_command(
-            self._kfx_input_convert_command.safe_substitute(input_file=input_file)
-        )
+        return await self._run_command(*self._kfx_input_convert_command, input_file)
 
     async def convert_ebook(  # noqa: C901, PLR0913
         self,
@@ -176,40 +222,35 @@ class Converter:
         conversion_error = ""
         set_to_rtl: bool | None = None
         input_type: str = input_file.suffix.lower()[1:]
-        output_file: Path = input_file.with_suffix(f".{output_type}")
-        # EPUB pre-processing
+        parent, stem = input_file.parent, input_file.stem
+        output_file: Path = parent / f"{stem}.{output_type}"
+        # EPUB pre-processing (lxml/zip work, kept off the event loop)
         if input_type == "epub":
             if force_rtl:
-                set_to_rtl = set_epub_to_rtl(input_file)
+                set_to_rtl = await asyncio.to_thread(set_epub_to_rtl, input_file)
             if fix_epub:
-                fix_content_opf_problems(input_file)
+                await asyncio.to_thread(fix_content_opf_problems, input_file)
             if flat_toc:
-                flatten_toc(input_file)
+                await asyncio.to_thread(flatten_toc, input_file)
         # Conversion
         if input_type in self.kfx_input_allowed_types:
             _, conversion_error = await self._convert_from_kfx_to_epub(input_file)
             if output_type == "epub" and force_rtl:
-                set_to_rtl = set_epub_to_rtl(output_file)
+                set_to_rtl = await asyncio.to_thread(set_epub_to_rtl, output_file)
             else:
                 # 2nd step conversion
-                epub_file: Path = input_file.with_suffix(".epub")
+                epub_file: Path = parent / f"{stem}.epub"
                 if force_rtl:
-                    set_to_rtl = set_epub_to_rtl(epub_file)
-                await self._run_command(
-                    self._convert_command.safe_substitute(
-                        input_file=epub_file, output_file=output_file
-                    )
-                )
-                epub_file.unlink(missing_ok=True)
+                    set_to_rtl = await asyncio.to_thread(set_epub_to_rtl, epub_file)
+                await self._run_command(*self._convert_command, epub_file, output_file)
+                await remove_files(epub_file)
         if output_type == "kfx" and input_type in self.kfx_output_allowed_types:
             _, conversion_error = await self._convert_to_kfx(input_file)
         if output_type in self.supported_output_types:
             if input_type != output_type:
                 _, conversion_error = await self._run_command(
-                    self._convert_command.safe_substitute(
-                        input_file=input_file, output_file=output_file
-                    )
+                    *self._convert_command, input_file, output_file
                 )
             if output_type == "epub" and force_rtl:
-                set_to_rtl = set_epub_to_rtl(output_file)
+                set_to_rtl = await asyncio.to_thread(set_epub_to_rtl, output_file)
         return output_file, set_to_rtl, conversion_error
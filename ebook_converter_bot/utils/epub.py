@@ -4,9 +4,21 @@ from typing import cast
 from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
 from lxml import html
-from lxml.etree import Element, ElementTree, ParseError, XMLParser, fromstring, tostring
+from lxml.etree import (
+    Element,
+    ElementTree,
+    ParseError,
+    XMLParser,
+    XPath,
+    fromstring,
+    tostring,
+)
 
 xml_parser = XMLParser(resolve_entities=False)
+ncx_spine_pattern = re.compile(r'<spine\s+[^>]*toc="ncx"[^>]*>')
+ncx_spine_start_pattern = re.compile(r'<spine\s+[^>]*toc="ncx"')
+spine_line_pattern = re.compile(r"<spine .*\n")
+nested_ol_xpath = XPath(".//*/ol/*/ol")
 
 
 def set_epub_to_rtl(input_file: Path) -> bool:
@@ -15,11 +27,10 @@ def set_epub_to_rtl(input_file: Path) -> bool:
             filter(lambda x: x.filename.endswith(".opf"), epub_book.infolist())
         ).pop()
         opf_file_content = epub_book.read(content_opf.filename).decode()
-        if match := re.search(r'<spine\s+[^>]*toc="ncx"[^>]*>', opf_file_content):
+        if match := ncx_spine_pattern.search(opf_file_content):
             spine_element = match.group(0)
             if "rtl" not in spine_element:
-                new_opf_file_content = re.sub(
-                    r'<spine\s+[^>]*toc="ncx"',
+                new_opf_file_content = ncx_spine_start_pattern.sub(
                     r'<spine page-progression-direction="rtl" toc="ncx"',
                     opf_file_content,
                 )
@@ -48,77 +59,81 @@ def fix_content_opf_problems(input_file: Path) -> None:
         opf_file_content = epub_book.read(content_opf.filename).decode()
         manifest_wrong_list_pos = opf_file_content.find('<item id="page_1"')
         manifest_correct_list_pos = opf_file_content.rfind('<item id="page_1"')
-        manifest_end_pos = opf_file_content.find("</manifest>")
-        spine_line_match = re.search(r"<spine .*\n", opf_file_content)
-        assert spine_line_match is not None
-        spine_line = spine_line_match.group(0)
-        spine_correct_list_pos = opf_file_content.rfind('<itemref idref="page_1"')
-        new_content = (
-            opf_file_content[:manifest_wrong_list_pos]
-            + opf_file_content[manifest_correct_list_pos:manifest_end_pos]
-            + "</manifest>"
-            + spine_line
-            + opf_file_content[spine_correct_list_pos:]
-        )
+        if manifest_wrong_list_pos == manifest_correct_list_pos:
+            # The pages are not listed twice, there is nothing to remove
+            new_content = opf_file_content
+        else:
+            manifest_end_pos = opf_file_content.find("</manifest>")
+            spine_line_match = spine_line_pattern.search(opf_file_content)
+            assert spine_line_match is not None
+            spine_line = spine_line_match.group(0)
+            spine_correct_list_pos = opf_file_content.rfind('<itemref idref="page_1"')
+            new_content = (
+                opf_file_content[:manifest_wrong_list_pos]
+                + opf_file_content[manifest_correct_list_pos:manifest_end_pos]
+                + "</manifest>"
+                + spine_line
+                + opf_file_content[spine_correct_list_pos:]
+            )
         # Fix missing text content exists in content.opf
         try:
-            zip_text_contents = [
+            zip_text_contents = {
                 i.get("href").split("/")[-1]
                 for i in fromstring(new_content.encode(), xml_parser)[1]  # noqa: S320
                 if "Text" in i.get("href")
-            ]
-            real_text_contents = [
+            }
+            real_text_contents = {
                 i.split("/")[-1] for i in epub_book.namelist() if "Text" in i
-            ]
-            missing_text_content = list(
-                set(zip_text_contents) - set(real_text_contents)
-            )
-            for item in missing_text_content:
-                new_content = re.sub(f'<item .*{item}".*\n', "", new_content)
+            }
+            if missing_text_content := zip_text_contents - real_text_contents:
+                missing_items_pattern = "|".join(
+                    re.escape(item) for item in missing_text_content
+                )
+                new_content = re.sub(
+                    f'<item .*(?:{missing_items_pattern})".*\n', "", new_content
+                )
         except ParseError:
             pass
+        if new_content == opf_file_content:
+            return
         with epub_book.open(content_opf.filename, "w") as o:
             o.write(new_content.encode())
 
 
 def _flatten_ncx_toc(nav_map: Element, namespace: str) -> list[Element]:
     flattened_items: list[Element] = []
-
-    def traverse_nav_point(nav_point: Element, play_order: int) -> None:
+    nav_point_tag = f"{namespace}navPoint"
+    # Depth-first traversal in document order, using a stack instead of recursion
+    stack: list[Element] = list(reversed(nav_map))
+    while stack:
+        nav_point = stack.pop()
+        play_order = len(flattened_items) + 1
         # Create a new navPoint element with updated attributes
         new_nav_point = Element(
             "navPoint", {"id": f"num_{play_order}", "playOrder": str(play_order)}
         )
+        nested_nav_points = list(nav_point.iterchildren(tag=nav_point_tag))
         # Copy the child elements (navLabel and content) from the original navPoint to the new one
         for child in nav_point:
-            if child.tag != f"{namespace}navPoint":
+            if child.tag != nav_point_tag:
                 new_nav_point.append(child)
         # Add the new item
         flattened_items.append(new_nav_point)
-
-        # Recursively traverse nested navPoints
-        for child in nav_point:
-            if child.tag == f"{namespace}navPoint":
-                play_order += 1
-                traverse_nav_point(child, play_order)
-
-    for idx, navigation_point in enumerate(nav_map, start=1):
-        traverse_nav_point(navigation_point, idx)
+        # Nested navPoints come right after their parent
+        stack.extend(reversed(nested_nav_points))
 
     return flattened_items
 
 
 def _flatten_html_nav(html_nav_file: bytes) -> bytes:
     root = html.fromstring(html_nav_file)
-    nested_ol_elems = root.xpath(".//*/ol/*/ol")
-    # Flatten the nested lists
-    for nested_ol in nested_ol_elems:
+    # Flatten the nested lists, innermost first so each one is unwrapped once:
+    # its items are moved right after the item that contained them.
+    for nested_ol in reversed(nested_ol_xpath(root)):
         parent_li = nested_ol.getparent()
         parent_ol = parent_li.getparent()
-        index = parent_ol.index(parent_li)
-        parent_ol.remove(parent_li)
-        for li in reversed(nested_ol):
-            parent_ol.insert(index, li)
+        index = parent_ol.index(parent_li) + 1
+        parent_ol[index:index] = list(nested_ol)
         nested_ol.drop_tree()
     return cast(bytes, tostring(root, encoding="utf-8"))
 
@@ -138,12 +153,8 @@ def flatten_toc(input_file: Path) -> None:
         root: Element = toc_xml.getroot()
         namespace = root.tag.split("}")[0] + "}"
         nav_map: Element = toc_xml.find(f".//{namespace}navMap")
-        new_toc = _flatten_ncx_toc(nav_map, namespace)
-        root.remove(nav_map)
-        new_nav_map = Element("navMap")
-        for i in new_toc:
-            new_nav_map.append(i)
-        root.append(new_nav_map)
+        # Replace the navMap children in place, keeping its tag and position
+        nav_map[:] = _flatten_ncx_toc(nav_map, namespace)
         # print(tostring(root, encoding="utf-8").decode('utf-8'))
         with epub_book.open(toc_ncx.filename, "w") as o:
             o.write(tostring(toc_xml, encoding="utf-8"))
@@ -161,6 +172,9 @@ def flatten_toc(input_file: Path) -> None:
 
 
 if __name__ == "__main__":
+    from concurrent.futures import ProcessPoolExecutor
     from sys import argv
 
-    flatten_toc(Path(argv[1]))
+    # Each book is independent, flatten them in parallel
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(flatten_toc, map(Path, argv[1:])))
@@ -1,3 +1,5 @@
+import re
+from functools import lru_cache
 from gettext import GNUTranslations, NullTranslations, translation
 
 from ebook_converter_bot import LANGUAGES, LOCALE_PATH
@@ -8,12 +10,11 @@ TRANSLATIONS: dict[str, GNUTranslations | NullTranslations] = {
     )
     for lang in LANGUAGES
 }
+MULTIPLE_SPACES_PATTERN = re.compile(" {2,}")
 
 
+@lru_cache(maxsize=512)
 def translate(string: str, lang: str | None) -> str:
     if not lang:
         lang = "en"
-    translated = TRANSLATIONS[lang].gettext(string)
-    while "  " in translated:
-        translated = translated.replace("  ", " ")
-    return translated
+    return MULTIPLE_SPACES_PATTERN.sub(" ", TRANSLATIONS[lang].gettext(string))